@@ -0,0 +1,363 @@
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import orjson
+import requests
+from cachetools import TTLCache
+from hyundai_kia_connect_api import VehicleManager, ClimateRequestOptions
+from hyundai_kia_connect_api.exceptions import AuthenticationError
+from requests.adapters import HTTPAdapter
+
+# Owns the Kia Vehicle Manager: login token, connection pool, background
+# refresh and status cache. main.py uses it in-process by default. With
+# KIA_DAEMON_SOCKET set, run `python kia_daemon.py` once next to gunicorn and
+# every worker talks to this single process over a UNIX socket instead of
+# each logging in and polling Kia on its own.
+
+log = logging.getLogger("kia")
+
+# Get credentials from environment variables
+USERNAME = os.environ.get('KIA_USERNAME')
+PASSWORD = os.environ.get('KIA_PASSWORD')
+PIN = os.environ.get('KIA_PIN')
+
+# The login token is kept on disk so a restart can skip Kia's multi-step
+# login. Set KIA_TOKEN_CACHE to an empty string to disable.
+TOKEN_CACHE = os.environ.get("KIA_TOKEN_CACHE", "/var/cache/kia/token.pkl")
+
+def _load_token():
+    if not TOKEN_CACHE:
+        return None
+    try:
+        with open(TOKEN_CACHE, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("Ignoring unreadable token cache %s: %s", TOKEN_CACHE, e)
+        return None
+
+def _save_token(token):
+    if not TOKEN_CACHE:
+        return
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE), mode=0o700, exist_ok=True)
+        # The token holds the account credentials; keep it private to us
+        fd = os.open(TOKEN_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(TOKEN_CACHE, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(token, f)
+    except Exception as e:
+        log.warning("Could not write token cache %s: %s", TOKEN_CACHE, e)
+
+# The SDK's USA clients keep a single requests.Session (Kia: `session`,
+# Hyundai: `sessions`), so connections are already kept alive. Its default
+# pool only holds 10 connections, though, and with every gunicorn thread going
+# through this process the extras would be thrown away and pay a fresh TLS
+# handshake each time. Remount with a pool sized for 4 workers x 8 threads,
+# keeping the SDK's adapter class so its custom TLS settings survive.
+POOL_MAXSIZE = 32
+
+def _tune_session(vm):
+    session = getattr(vm.api, "session", None) or getattr(vm.api, "sessions", None)
+    if not isinstance(session, requests.Session):
+        return
+
+    for prefix, adapter in list(session.adapters.items()):
+        if isinstance(adapter, HTTPAdapter):
+            session.mount(prefix, type(adapter)(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=1))
+
+# Background refresh of the cached vehicle state. vehicles() and battery()
+# read straight from vehicle_manager.vehicles, so they never wait on Kia.
+# _vm_lock serializes the calls that update vehicle_manager; readers only look
+# at attributes and don't take it.
+REFRESH_INTERVAL = float(os.environ.get("REFRESH_INTERVAL", "60"))
+TOKEN_REFRESH_INTERVAL = 30 * 60
+_vm_lock = threading.RLock()
+
+def _refresh_loop():
+    last_token_check = time.monotonic()
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            with _vm_lock:
+                if time.monotonic() - last_token_check >= TOKEN_REFRESH_INTERVAL:
+                    if vehicle_manager.check_and_refresh_token():
+                        _save_token(vehicle_manager.token)
+                    last_token_check = time.monotonic()
+                vehicle_manager.update_all_vehicles_with_cached_state()
+            log.debug("Background refresh complete")
+        except Exception as e:
+            log.error("Background refresh failed: %s", e)
+
+# The Vehicle Manager is created on first use rather than at import, so the
+# API binds its port without waiting on Kia's login and each gunicorn worker
+# running in-process initializes once, after forking.
+vehicle_manager = None
+VEHICLE_ID = os.environ.get("VEHICLE_ID")
+_init_lock = threading.Lock()
+
+def _ensure_vm():
+    global vehicle_manager, VEHICLE_ID
+
+    if vehicle_manager is not None:
+        return vehicle_manager
+
+    with _init_lock:
+        if vehicle_manager is not None:
+            return vehicle_manager
+
+        vm = VehicleManager(
+            region=3,  # North America region
+            brand=1,   # KIA brand
+            username=USERNAME,
+            password=PASSWORD,
+            pin=str(PIN)
+        )
+        _tune_session(vm)
+
+        # Reuse the saved token if Kia still accepts it. A rejected token falls
+        # through to the full login below.
+        saved_token = _load_token()
+        if saved_token is not None:
+            try:
+                log.info("Reusing saved token...")
+                vm.token = saved_token
+                for vehicle in vm.api.get_vehicles(vm.token):
+                    vm.vehicles[vehicle.id] = vehicle
+                if vm.check_and_refresh_token():
+                    _save_token(vm.token)
+            except Exception as e:
+                log.info("Saved token rejected, logging in again: %s", e)
+                vm.token = None
+                vm.vehicles = {}
+
+        # Refresh the token and update vehicle states
+        try:
+            if vm.token is None:
+                log.info("Attempting to authenticate and refresh token...")
+                vm.check_and_refresh_token()
+                log.info("Token refreshed successfully.")
+                _save_token(vm.token)
+
+            log.info("Updating vehicle states...")
+            vm.update_all_vehicles_with_cached_state()
+            log.info("Connected! Found %d vehicle(s).", len(vm.vehicles))
+
+            for vid, vehicle in vm.vehicles.items():
+                log.info("Vehicle ID: %s, Name: %s, Model: %s, Battery: %s", vid, vehicle.name, vehicle.model, vehicle.ev_battery_percentage)
+
+        except AuthenticationError as e:
+            log.error("Failed to authenticate: %s", e)
+            raise
+        except Exception as e:
+            log.error("Unexpected error during initialization: %s", e)
+            raise
+
+        # Dynamically fetch the first vehicle ID if VEHICLE_ID is not set
+        if not VEHICLE_ID:
+            if not vm.vehicles:
+                raise ValueError("No vehicles found in the account. Please ensure your Kia account has at least one vehicle.")
+            # Fetch the first vehicle ID
+            VEHICLE_ID = next(iter(vm.vehicles.keys()))
+            log.info("No VEHICLE_ID provided. Using the first vehicle found: %s", VEHICLE_ID)
+
+        vehicle_manager = vm
+        threading.Thread(target=_refresh_loop, name="kia-refresh", daemon=True).start()
+
+    return vehicle_manager
+
+# Short-lived status snapshots, keyed by vehicle id. Shortcuts/Siri tend to
+# poll every few seconds; within the TTL we reuse the last snapshot instead of
+# waking the car again. TTLCache isn't thread-safe, hence the lock.
+CACHE_TTL = float(os.environ.get("STATUS_TTL", "30"))
+_snap = TTLCache(maxsize=8, ttl=CACHE_TTL)
+_snap_lock = threading.Lock()
+
+# Last non-zero range per vehicle; the car sometimes reports 0 while asleep
+_last_good_range = {}
+
+# Requests currently talking to Kia, keyed by what they fetch. Concurrent
+# callers for the same key wait on the first caller instead of each issuing
+# their own upstream refresh.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def _single_flight(key, fetch):
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event(), "result": None, "error": None}
+            _inflight[key] = flight
+
+    if not leader:
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+
+    try:
+        flight["result"] = fetch()
+        return flight["result"]
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        flight["done"].set()
+
+def _fetch_snapshot(vid):
+    # Wakes the car for live data, unlike the cached state _refresh_loop pulls
+    with _vm_lock:
+        vehicle_manager.check_and_force_update_vehicles(force_refresh_interval=0)
+    vehicle = vehicle_manager.vehicles[vid]
+
+    range_miles = vehicle.ev_driving_range
+    if range_miles and range_miles > 0:
+        _last_good_range[vid] = range_miles
+    if range_miles == 0:
+        range_miles = _last_good_range.get(vid)
+
+    payload = {
+        "battery_percentage": vehicle.ev_battery_percentage,
+        "range_miles": range_miles,
+        "model": vehicle.model,
+        "charging": vehicle.ev_battery_is_charging,
+        "charge_minutes": getattr(vehicle, "ev_estimated_current_charge_duration", None),  # ⏱️ Add this
+        "locked": getattr(vehicle, "is_locked", None)
+    }
+    # Store the encoded JSON so hits are served without re-serializing
+    body = orjson.dumps(payload)
+    with _snap_lock:
+        _snap[vid] = body
+    return body
+
+def _snapshot(vid):
+    with _snap_lock:
+        body = _snap.get(vid)
+    if body is not None:
+        return body
+
+    # Concurrent polls share a single upstream refresh
+    return _single_flight(vid, lambda: _fetch_snapshot(vid))
+
+def _command_vm():
+    vm = _ensure_vm()
+    # Commands don't need fresh state, only a known vehicle
+    if VEHICLE_ID not in vm.vehicles:
+        log.debug("Refreshing vehicle states...")
+        with _vm_lock:
+            vm.update_all_vehicles_with_cached_state()
+    return vm
+
+# Climate settings used by start_climate(). Built once and reused: the SDK only
+# fills in defaults for fields left as None, so sharing the object is safe.
+_DEFAULT_CLIMATE_OPTS = ClimateRequestOptions(
+    set_temp=65,  # Set temperature in Fahrenheit
+    duration=15,   # Duration in minutes
+#     defrost=False,
+    heating=0,
+    steering_wheel=0,        # 1 = on, 0 = off
+ #  front_left_seat=8        doesn't work at this time 4/4/25
+)
+
+# Attribute names don't depend on fresh telemetry, so compute them once
+_vehicle_attrs_cache = None
+
+# The calls main.py makes. Everything returned is plain data (or JSON bytes)
+# so it can cross the socket unchanged.
+class KiaService:
+    def __init__(self):
+        if USERNAME is None or PASSWORD is None or PIN is None:
+            raise ValueError("Missing credentials! Check your environment variables.")
+
+    def status(self):
+        _ensure_vm()
+        return _snapshot(VEHICLE_ID)
+
+    def vehicles(self):
+        # Iterate over the dictionary values (Vehicle objects)
+        return [
+            {
+                "name": v.name,
+                "id": v.id,
+                "model": v.model,
+                "year": v.year
+            }
+            for v in _ensure_vm().vehicles.values()
+        ]
+
+    def battery(self):
+        # None when the configured vehicle isn't on the account
+        vehicle = _ensure_vm().vehicles.get(VEHICLE_ID)
+        if not vehicle:
+            return None
+        return {"battery_percentage": vehicle.ev_battery_percentage}  # EV battery SOC
+
+    def vehicle_attributes(self):
+        global _vehicle_attrs_cache
+        if _vehicle_attrs_cache is None:
+            _vehicle_attrs_cache = dir(_ensure_vm().vehicles[VEHICLE_ID])
+        return _vehicle_attrs_cache
+
+    def start_climate(self):
+        return _command_vm().start_climate(VEHICLE_ID, _DEFAULT_CLIMATE_OPTS)
+
+    def stop_climate(self):
+        return _command_vm().stop_climate(VEHICLE_ID)
+
+    def lock(self):
+        return _command_vm().lock(VEHICLE_ID)
+
+    def unlock(self):
+        return _command_vm().unlock(VEHICLE_ID)
+
+
+class KiaManager(BaseManager):
+    pass
+
+# Clients register the typeid without a callable; main() below re-registers it
+# with the service instance it serves
+KiaManager.register("kia")
+
+def connect(address, authkey):
+    manager = KiaManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.kia()
+
+def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+    address = os.environ.get("KIA_DAEMON_SOCKET", "/tmp/kia.sock")
+    secret_key = os.environ.get("SECRET_KEY")
+    if not secret_key:
+        raise ValueError("Missing SECRET_KEY environment variable.")
+
+    service = KiaService()
+
+    # Log in up front; there's no port to hold up in the sidecar
+    try:
+        _ensure_vm()
+    except Exception:
+        sys.exit(1)
+
+    KiaManager.register("kia", callable=lambda: service)
+
+    if os.path.exists(address):
+        os.unlink(address)
+    server = KiaManager(address=address, authkey=secret_key.encode()).get_server()
+    os.chmod(address, 0o600)
+
+    log.info("Kia daemon listening on %s", address)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()